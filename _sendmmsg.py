@@ -0,0 +1,84 @@
+"""ctypes wrapper for Linux sendmmsg(2).
+
+Lets the forwarder emit one datagram to N destinations with a single
+syscall instead of N sendto() calls. Only available on Linux; callers
+should check `available` and fall back to a sendto loop otherwise.
+"""
+import ctypes
+import os
+import socket
+import struct
+import sys
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+# sendmmsg(2) is Linux-only; do not even attempt the CDLL(None) dance
+# elsewhere (on Windows it raises TypeError, which would break the
+# import and take the service down with it)
+if sys.platform == 'linux':
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError, TypeError):
+        _sendmmsg = None
+else:
+    _sendmmsg = None
+
+available = _sendmmsg is not None
+
+
+def pack_sockaddr_in(host, port):
+    """Build sockaddr_in bytes for an AF_INET host/port.
+
+    Resolves the host, so call this at config time, not per packet.
+    """
+    addr = socket.inet_aton(socket.gethostbyname(host))
+    return (struct.pack('=H', socket.AF_INET) +
+            struct.pack('>H4s', port, addr) +
+            b'\x00' * 8)
+
+
+def sendmmsg(fd, data, sockaddrs):
+    """Send data to every packed sockaddr_in in one syscall.
+
+    Returns the number of messages sent; raises OSError on failure.
+    """
+    n = len(sockaddrs)
+    buf = ctypes.create_string_buffer(data, len(data))
+    names = [ctypes.create_string_buffer(sa, len(sa)) for sa in sockaddrs]
+    iovs = (_iovec * n)()
+    msgs = (_mmsghdr * n)()
+    for i in range(n):
+        iovs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+        iovs[i].iov_len = len(data)
+        msgs[i].msg_hdr.msg_name = ctypes.cast(names[i], ctypes.c_void_p)
+        msgs[i].msg_hdr.msg_namelen = len(sockaddrs[i])
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    sent = _sendmmsg(fd, msgs, n, 0)
+    if sent < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return sent
@@ -0,0 +1,103 @@
+/*
+ * Optional C helper for the WSJTX packet hot path in qsofwdsvc.py.
+ *
+ * Build in place with:
+ *   python setup.py build_ext --inplace
+ *
+ * qsofwdsvc falls back to the pure-Python parser if this module is
+ * not importable, so building it is never required.
+ */
+#include <Python.h>
+
+#define WSJTX_MAGIC 0xADBCCBDAUL
+#define WSJTX_SCHEMA 2UL
+
+static unsigned long
+be32(const unsigned char *b)
+{
+    return ((unsigned long)b[0] << 24) |
+           ((unsigned long)b[1] << 16) |
+           ((unsigned long)b[2] << 8) |
+           (unsigned long)b[3];
+}
+
+/* parse_header(data) -> (number, ident_bytes) or None if not WSJTX */
+static PyObject *
+parse_header(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    const unsigned char *b;
+    unsigned long number, size;
+    PyObject *ident, *ret;
+
+    if (!PyArg_ParseTuple(args, "y*", &buf))
+        return NULL;
+    b = buf.buf;
+    if (buf.len < 16 ||
+        be32(b) != WSJTX_MAGIC ||
+        be32(b + 4) != WSJTX_SCHEMA) {
+        PyBuffer_Release(&buf);
+        Py_RETURN_NONE;
+    }
+    number = be32(b + 8);
+    size = be32(b + 12);
+    /* Clamp to the buffer like a Python slice would */
+    if (size > (unsigned long)(buf.len - 16))
+        size = buf.len - 16;
+    ident = PyBytes_FromStringAndSize((const char *)b + 16, size);
+    if (!ident) {
+        PyBuffer_Release(&buf);
+        return NULL;
+    }
+    ret = Py_BuildValue("(kN)", number, ident);
+    PyBuffer_Release(&buf);
+    return ret;
+}
+
+/* parse_string(data, offset) -> str */
+static PyObject *
+parse_string(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    Py_ssize_t offset;
+    const unsigned char *b;
+    unsigned long size;
+    PyObject *ret;
+
+    if (!PyArg_ParseTuple(args, "y*n", &buf, &offset))
+        return NULL;
+    if (offset < 0 || offset + 4 > buf.len) {
+        PyBuffer_Release(&buf);
+        PyErr_SetString(PyExc_ValueError, "string offset out of range");
+        return NULL;
+    }
+    b = buf.buf;
+    size = be32(b + offset);
+    if (size > (unsigned long)(buf.len - offset - 4))
+        size = buf.len - offset - 4;
+    ret = PyUnicode_DecodeUTF8((const char *)b + offset + 4, size, NULL);
+    PyBuffer_Release(&buf);
+    return ret;
+}
+
+static PyMethodDef wsjtxparse_methods[] = {
+    {"parse_header", parse_header, METH_VARARGS,
+     "parse_header(data) -> (number, ident) or None"},
+    {"parse_string", parse_string, METH_VARARGS,
+     "parse_string(data, offset) -> str"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef wsjtxparse_module = {
+    PyModuleDef_HEAD_INIT,
+    "_wsjtxparse",
+    "Fast WSJTX packet field extraction",
+    -1,
+    wsjtxparse_methods
+};
+
+PyMODINIT_FUNC
+PyInit__wsjtxparse(void)
+{
+    return PyModule_Create(&wsjtxparse_module);
+}
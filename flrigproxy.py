@@ -1,22 +1,70 @@
+import json
 import logging
 import os
 import platform
-import select
+import selectors
 import socket
+import struct
 import subprocess
 import sys
-import threading
 import time
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 LOG = logging.getLogger('rigproxy')
 
+
+def load_config(config_file):
+    """Load a YAML config, via a sibling JSON cache when it is current.
+
+    After a successful YAML parse, stash the result in
+    <config_file>.cache.json keyed on the YAML's mtime so the next
+    startup can skip the YAML parser entirely.
+    """
+    cache_file = config_file + '.cache.json'
+    mtime = os.stat(config_file).st_mtime
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache['mtime'] == mtime:
+            return cache['data']
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(config_file) as f:
+        config = yaml.load(f, Loader=SafeLoader)
+    # Not everything YAML can represent survives a JSON round-trip
+    # (dates become TypeError, non-string keys would come back as
+    # strings), so only cache configs that serialize cleanly and fall
+    # back to parsing the YAML every time otherwise
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump({'mtime': mtime, 'data': config}, f)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        LOG.debug('Unable to write config cache %s: %s', cache_file, e)
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+    return config
+
 class RigProxy:
-    """One instance of a serial->flrig proxy"""
-    def __init__(self, config, rig, proxy):
+    """One instance of a serial->flrig proxy
+
+    All proxies share one selector owned by RigProxies, which drives us
+    by calling tick() periodically and on_ready() when one of our
+    sockets has data.
+    """
+    def __init__(self, config, rig, proxy, sel):
         """
-        config is the whole blob, rig is index into rigs, and proxy is
-        index into that rig's list of proxy ports
+        config is the whole blob, rig is index into rigs, proxy is
+        index into that rig's list of proxy ports, and sel is the
+        shared selector owned by RigProxies
         """
         self.config = config
         self.rig = rig
@@ -24,9 +72,14 @@ class RigProxy:
         self.running = True
         self.log = logging.getLogger(self.config['rigs'][rig].get(
             'name', 'rig%i' % rig))
+        self._sel = sel
         self._flrig_sock = self._rigctlcom_sock = None
+        self._listen_sock = None
         self._rigctlcom = None
-        self._thread = None
+        # Receive into one preallocated buffer rather than allocating
+        # a fresh bytes object for every read
+        self._buf = bytearray(65536)
+        self._mv = memoryview(self._buf)
 
     @property
     def port(self):
@@ -37,45 +90,84 @@ class RigProxy:
         return self.config['rigs'][self.rig]['proxies'][self.proxy]
 
     def stop(self):
-        """Stops the proxy loop (and thread if running)"""
+        """Stops the proxy and kills rigctlcom, if running"""
         self.running = False
-        if self.thread:
-            self.thread.join(1)
+        self._reset()
         self.log.info('Stoppped')
 
     def start(self):
-        """Starts a thread to run the proxy loop"""
-        self.thread = threading.Thread(target=self.thread_loop)
-        self.thread.daemon = True
-        self.thread.start()
-        self.log.info('Started thread')
-
-    def thread_loop(self):
-        """The main meat of the proxy
-
-        Try/wait to connect to flrig. Once flrig is connected, spawn the
-        rigctlcom proxy, proxy data until one of them disconnects, then kill
-        everything and try again.
+        """Makes the first connection attempt; tick() handles retries"""
+        self.tick()
+        self.log.info('Started')
+
+    def tick(self):
+        """Periodic maintenance from the RigProxies loop
+
+        Try/wait to connect to flrig. Once flrig is connected, spawn
+        the rigctlcom proxy; from then on the selector events do the
+        work until something disconnects and we start over.
         """
-        while self.running:
-            try:
-                self._connect_flrig()
-                if self._flrig_sock and not self._rigctlcom:
-                    self._spawn_rigctlcom()
-                self._proxy_loop()
-            except ConnectionRefusedError:
-                pass
-            except socket.error as e:
-                self.log.debug('Socket reset: %s', e)
-                self._reset()
-            except Exception as e:
-                self.log.exception('Unexpected failure in loop: %s', e)
-                self._reset()
+        if not self.running or self._flrig_sock:
+            return
+        try:
+            self._connect_flrig()
+            self._spawn_rigctlcom()
+        except ConnectionRefusedError:
+            # flrig is not up yet; retry on a later tick
+            pass
+        except socket.error as e:
+            self.log.debug('Socket reset: %s', e)
+            self._reset()
+        except Exception as e:
+            self.log.exception('Unexpected failure in setup: %s', e)
+            self._reset()
+
+    def on_ready(self, tag):
+        """Selector callback: one of our sockets is readable"""
+        if self._flrig_sock is None:
+            # An earlier event in this same batch reset us, so this
+            # one refers to a socket that no longer exists
+            return
+        try:
+            if tag == 'listen':
+                self._accept_rigctlcom()
+            elif tag == 'rigctl':
+                nbytes = self._rigctlcom_sock.recv_into(self._buf)
+                if not nbytes:
+                    # Half-closed peer; reset and reconnect
+                    raise ConnectionResetError('rigctlcom closed')
+                self._flrig_sock.sendall(self._mv[:nbytes])
+                #self.log.debug('-> %i' % nbytes)
+            else:
+                nbytes = self._flrig_sock.recv_into(self._buf)
+                if not nbytes:
+                    raise ConnectionResetError('flrig closed')
+                self._rigctlcom_sock.sendall(self._mv[:nbytes])
+                #self.log.debug('<- %i' % nbytes)
+        except socket.error as e:
+            self.log.debug('Socket reset: %s', e)
+            self._reset()
+        except Exception as e:
+            self.log.exception('Unexpected failure in loop: %s', e)
+            self._reset()
+
+    def _unregister(self, sock):
+        try:
+            self._sel.unregister(sock)
+        except KeyError:
+            # Never made it to registration
+            pass
 
     def _reset(self):
         """Reset all our sockets and kill our rigctlcom, if running"""
+        if self._listen_sock:
+            self.log.debug('Closing listen socket')
+            self._unregister(self._listen_sock)
+            self._listen_sock.close()
+            self._listen_sock = None
         if self._rigctlcom_sock:
             self.log.debug('Closing rigctlcom socket')
+            self._unregister(self._rigctlcom_sock)
             self._rigctlcom_sock.close()
             self._rigctlcom_sock = None
         if self._rigctlcom:
@@ -86,64 +178,93 @@ class RigProxy:
             self._rigctlcom = None
         if self._flrig_sock:
             self.log.debug('Closing flrig socket')
+            self._unregister(self._flrig_sock)
             self._flrig_sock.close()
             self._flrig_sock = None
 
     def _connect_flrig(self):
-        self._flrig_sock = socket.socket(socket.AF_INET,
-                                         socket.SOCK_STREAM)
-        self._flrig_sock.connect(('127.0.0.1', self.port))
+        sock = socket.socket(socket.AF_INET,
+                             socket.SOCK_STREAM)
+        try:
+            sock.connect(('127.0.0.1', self.port))
+        except socket.error:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP,
+                        socket.TCP_NODELAY, 1)
+        self._flrig_sock = sock
         self.log.info('Connected to flrig on %i', self.port)
 
+    @staticmethod
+    def _make_listen_sock():
+        """Create a short-lived localhost listen socket for rigctlcom.
+
+        These get created on every reconnect, so allow address/port
+        reuse and a zero linger timeout to keep repeated resets from
+        piling up ports in TIME_WAIT.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        return sock
+
     def _spawn_rigctlcom(self):
         """Spawn a rigctlcom instance
 
         Allocates a random listen port and starts rigctlcom on the desired
-        serial proxy connected to that port.
+        serial proxy connected to that port. The actual connection is
+        accepted from the selector loop when rigctlcom dials in.
         """
         self.log.debug('Setting up rigctlcom')
 
         # Create a temporary listen socket on a random localhost port
-        listen_sock = socket.socket(socket.AF_INET,
-                                             socket.SOCK_STREAM)
-        listen_sock.bind(('127.0.0.1', 0))
-        listen_sock.listen()
+        self._listen_sock = self._make_listen_sock()
+        self._sel.register(self._listen_sock, selectors.EVENT_READ,
+                           (self, 'listen'))
 
         # Spawn rigctlcom to connect to that port
         cmd = [self.config['rigctlcom'], '-m4', '-S115200',
                 '-R%s' % self.serial,
-                '-r%s:%i' % listen_sock.getsockname()]
+                '-r%s:%i' % self._listen_sock.getsockname()]
         self.log.debug('Spawning rigctlcom with %s', cmd)
         self._rigctlcom = subprocess.Popen(cmd)
 
-        # Wait for rigctlcom to connect to us
-        self._rigctlcom_sock, peer = listen_sock.accept()
+    def _accept_rigctlcom(self):
+        """Accept the connection from our spawned rigctlcom"""
+        self._rigctlcom_sock, peer = self._listen_sock.accept()
+        # Rigctl commands and responses are tiny; disable Nagle so they
+        # are not held back waiting for more data
+        self._rigctlcom_sock.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY, 1)
         self.log.info('Rigctl connected')
 
         # We no longer need the parent listen socket
-        listen_sock.close()
-
-    def _proxy_loop(self):
-        """Proxy data between rigctlcom and flrig until one dies"""
-        socks = [self._rigctlcom_sock, self._flrig_sock]
-        while True:
-            r, _, x = select.select(socks, [], socks, 0.25)
-            if self._rigctlcom_sock in r:
-                data = self._rigctlcom_sock.recv(65536)
-                self._flrig_sock.send(data)
-                #self.log.debug('-> %i' % len(data))
-            if self._flrig_sock in r:
-                data = self._flrig_sock.recv(65536)
-                self._rigctlcom_sock.send(data)
-                #self.log.debug('<- %i' % len(data))
+        self._unregister(self._listen_sock)
+        self._listen_sock.close()
+        self._listen_sock = None
+
+        # Register both sides once; from here on the RigProxies loop
+        # feeds us events until something disconnects
+        self._sel.register(self._rigctlcom_sock, selectors.EVENT_READ,
+                           (self, 'rigctl'))
+        self._sel.register(self._flrig_sock, selectors.EVENT_READ,
+                           (self, 'flrig'))
 
 
 class RigProxies:
-    """Multi-rig multi-proxy"""
+    """Multi-rig multi-proxy
+
+    One selector and one loop serve every proxy, instead of a thread
+    blocked in select per serial port.
+    """
     def __init__(self, config_file):
         self._config_file = config_file
-        with open(config_file) as f:
-            self.config = yaml.load(f, Loader=yaml.SafeLoader)
+        self.config = load_config(config_file)
 
         try:
             level = getattr(logging, self.config.get('loglevel', 'WARNING'))
@@ -151,18 +272,32 @@ class RigProxies:
         except AttributeError:
             LOG.error('Unknown loglevel %r', self.config['loglevel'])
 
+        self._sel = selectors.DefaultSelector()
+        self._last_tick = 0.0
         self.proxies = []
         for i, rig in enumerate(self.config['rigs']):
             for j, proxy in enumerate(rig['proxies']):
-                p = RigProxy(self.config, i, j)
+                p = RigProxy(self.config, i, j, self._sel)
                 p.start()
                 self.proxies.append(p)
 
+    def run_iteration(self, timeout=1.0):
+        """One pass of the event loop: dispatch IO, then housekeeping"""
+        events = self._sel.select(timeout)
+        for key, _ in events:
+            proxy, tag = key.data
+            proxy.on_ready(tag)
+        now = time.monotonic()
+        if now - self._last_tick >= 1.0:
+            self._last_tick = now
+            for p in self.proxies:
+                p.tick()
+
     def poll(self):
         try:
             while True:
-                time.sleep(0.25)
-        except Exception:
+                self.run_iteration(1.0)
+        except KeyboardInterrupt:
             pass
         for p in self.proxies:
             p.stop()
@@ -196,11 +331,12 @@ if platform.system() == 'Windows':
                 'flrigproxy.yaml')
             self.proxies = RigProxies(config_file)
             while True:
-                result = win32event.WaitForSingleObject(self.event, 1)
+                result = win32event.WaitForSingleObject(self.event, 0)
                 if result == win32event.WAIT_OBJECT_0:
                     LOG.info('Exiting')
                     break
-            for p in self.proxies:
+                self.proxies.run_iteration(1.0)
+            for p in self.proxies.proxies:
                 p.stop()
 
         def SvcStop(self):
@@ -1,13 +1,29 @@
+import json
 import logging
 import logging.handlers
 import os
 import platform
-import select
+import selectors
 import socket
 import struct
 import sys
+import time
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    # Optional C helper for the per-packet parse path; build with
+    # 'python setup.py build_ext --inplace'
+    import _wsjtxparse
+except ImportError:
+    _wsjtxparse = None
+
+import _sendmmsg
+
 LOG = logging.getLogger('qsofwd')
 LOGF = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                     'qsofwd_log.txt')
@@ -21,55 +37,168 @@ logging.basicConfig(level=logging.DEBUG,
 
 WSJTX_HEARTBEAT = 0
 
+# Precompiled on-wire formats; parse runs for every packet. The magic
+# is kept as raw bytes so bogus packets are rejected with a single
+# bytes compare before any unpacking happens
+_MAGIC = b'\xad\xbc\xcb\xda'
+_HDR_REST = struct.Struct('>II')
+_U32 = struct.Struct('>I')
+
+
+def load_config(config_file):
+    """Load a YAML config, via a sibling JSON cache when it is current.
+
+    YAML parsing is slow enough to matter when the config is reloaded
+    often, so after a successful parse we stash the result in
+    <config_file>.cache.json keyed on the YAML's mtime and load that
+    directly next time if the mtime still matches.
+    """
+    cache_file = config_file + '.cache.json'
+    mtime = os.stat(config_file).st_mtime
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache['mtime'] == mtime:
+            return cache['data']
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(config_file) as f:
+        config = yaml.load(f, Loader=SafeLoader)
+    # Not everything YAML can represent survives a JSON round-trip
+    # (dates become TypeError, non-string keys would come back as
+    # strings), so only cache configs that serialize cleanly and fall
+    # back to parsing the YAML every time otherwise
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump({'mtime': mtime, 'data': config}, f)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        LOG.debug('Unable to write config cache %s: %s', cache_file, e)
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+    return config
+
 class WSJPacket:
+    __slots__ = ('type', 'ident', 'version', 'revision', 'max_schema')
+
+    @classmethod
+    def parse_header(cls, message):
+        """Fast path for routing: just the type number and the ident.
+
+        The ident comes back as raw bytes (no decode) since it is only
+        used as a dict key. Returns (None, None) on a bogus packet.
+        """
+        if _wsjtxparse is not None:
+            hdr = _wsjtxparse.parse_header(message)
+            if hdr is None:
+                LOG.error('Invalid packet: %r', bytes(message[:8]))
+                return None, None
+            return hdr
+        if len(message) < 16 or message[:4] != _MAGIC:
+            LOG.error('Invalid packet: %r', bytes(message[:8]))
+            return None, None
+        schema, number = _HDR_REST.unpack_from(message, 4)
+        if schema != 2:
+            LOG.error('Invalid schema %i', schema)
+            return None, None
+        size, = _U32.unpack_from(message, 3 * 4)
+        return number, bytes(message[4 * 4:4 * 4 + size])
+
+    @classmethod
+    def parse_ident_only(cls, message):
+        """Cheapest routing parse: validate the magic, return raw ident.
+
+        Replies are routed purely on ident, so skip even the schema and
+        type number. Returns None on a bogus packet.
+        """
+        if _wsjtxparse is not None:
+            hdr = _wsjtxparse.parse_header(message)
+            if hdr is None:
+                LOG.error('Invalid packet: %r', bytes(message[:8]))
+                return None
+            return hdr[1]
+        if len(message) < 16 or message[:4] != _MAGIC:
+            LOG.error('Invalid packet: %r', bytes(message[:8]))
+            return None
+        size, = _U32.unpack_from(message, 3 * 4)
+        return bytes(message[4 * 4:4 * 4 + size])
+
     @classmethod
     def parse(cls, message):
-        magic, schema, number = struct.unpack('>III', message[:3 * 4])
-        if magic != 0xADBCCBDA:
-            LOG.error('Invalid magic: %08x', magic)
+        if message[:4] != _MAGIC:
+            LOG.error('Invalid magic: %08x', _U32.unpack_from(message, 0)[0])
             return
+        schema, number = _HDR_REST.unpack_from(message, 4)
         if schema != 2:
             LOG.error('Invalid schema %i', schema)
             return
         ident = cls.parse_string(message, 3 * 4)
         if number == 0:
             props = cls.parse_type_0(message, 4 * 4 + len(ident))
-        else:
-            props = {}
-        props.update({'type': number, 'ident': ident})
-        return cls(**props)
+            return cls(number, ident, **props)
+        return cls(number, ident)
 
     @classmethod
     def parse_type_0(cls, message, offset):
-        max_schema = struct.unpack('>I', message[offset:offset + 4])
+        max_schema, = _U32.unpack_from(message, offset)
         offset += 4
         version = cls.parse_string(message, offset)
-        offset += len(version)
+        offset += 4 + len(version)
         revision = cls.parse_string(message, offset)
         return dict(version=version,
                     revision=revision, max_schema=max_schema)
 
     @staticmethod
     def parse_string(buffer, offset):
-        size, = struct.unpack('>I', buffer[offset:offset + 4])
-        return buffer[offset + 4:offset + 4 + size].decode()
-
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+        if _wsjtxparse is not None:
+            return _wsjtxparse.parse_string(buffer, offset)
+        size, = _U32.unpack_from(buffer, offset)
+        return str(buffer[offset + 4:offset + 4 + size], 'utf-8')
+
+    def __init__(self, type, ident, version=None, revision=None,
+                 max_schema=None):
+        self.type = type
+        self.ident = ident
+        self.version = version
+        self.revision = revision
+        self.max_schema = max_schema
 
 
 class WSJTXSource:
     def __init__(self, ident, dest):
         self.ident = ident
         self.dest = dest
-        self.proxysock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 
 class QSOForwarder:
     def _parse_config(self, config_file):
-        with open(config_file) as f:
-            self._config = yaml.load(f, Loader=yaml.SafeLoader)
+        self._config = load_config(config_file)
+        # Precompute the destination addresses once here so the
+        # per-packet fan-out loop does no dict lookups or string
+        # formatting. The names live in a parallel tuple that is only
+        # consulted when a send fails
+        names = []
+        addrs = []
+        for d in self._config.get('destinations', []):
+            host = d.get('host', '127.0.0.1')
+            names.append(d.get('name', '%s:%s' % (host, d['port'])))
+            addrs.append((host, d['port']))
+        self._dest_names = tuple(names)
+        self._destinations = tuple(addrs)
+        # With use_sendmmsg set (Linux only), the whole fan-out happens
+        # in one syscall against these precomputed sockaddrs
+        self._dest_sockaddrs = None
+        if self._config.get('use_sendmmsg') and _sendmmsg.available:
+            try:
+                self._dest_sockaddrs = tuple(
+                    _sendmmsg.pack_sockaddr_in(*addr)
+                    for addr in self._destinations)
+            except socket.error as e:
+                LOG.warning('Unable to resolve destinations for '
+                            'sendmmsg: %s', e)
         LOG.info('Loaded config %s', config_file)
         self._last_config = os.stat(config_file).st_mtime
         try:
@@ -77,9 +206,17 @@ class QSOForwarder:
             LOG.setLevel(level)
         except AttributeError:
             LOG.error('Unknown loglevel %r', self._config['loglevel'])
+        # Cached so the packet path can skip chatty log calls entirely
+        self._info_enabled = LOG.isEnabledFor(logging.INFO)
 
     @property
     def config(self):
+        # Checking for a changed config costs a stat() every time, so
+        # only bother every five seconds
+        now = time.monotonic()
+        if now - self._last_config_check < 5.0:
+            return self._config
+        self._last_config_check = now
         config_file = os.path.join(os.path.dirname(
             os.path.abspath(__file__)), 'qsofwd.yaml')
         s = os.stat(config_file)
@@ -90,83 +227,146 @@ class QSOForwarder:
                 LOG.exception('Failed to load config: %s', e)
         return self._config
 
+    @property
+    def destinations(self):
+        # Touch the (throttled) config property so edits are still
+        # noticed from the packet path
+        self.config
+        return self._destinations
+
     def setup(self):
         self._last_config = 0
+        self._last_config_check = 0.0
         self._config = {}
+        self._destinations = ()
+        self._dest_names = ()
+        self._dest_sockaddrs = None
+        self._info_enabled = LOG.isEnabledFor(logging.INFO)
         self.inbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.inbound.setblocking(0)
         source = self.config.get('source', {})
         source_addr = (source.get('host', '0.0.0.0'),
                        source.get('port', 2237))
         self.inbound.bind(source_addr)
-        LOG.debug('Listening on %s:%i' % source_addr)
+        LOG.debug('Listening on %s:%i', *source_addr)
         self.sources = {}
-
-    def run_one(self):
-        proxysocks = {src.ident: src.proxysock
-                      for src in self.sources.values()}
-        sockets = [self.inbound] + list(proxysocks.values())
-        readable, _, _ = select.select(sockets, [], sockets, 0.25)
-
+        # Receive into one preallocated buffer instead of having
+        # recvfrom allocate a fresh 64K bytes object per packet
+        self._recv_buf = bytearray(65536)
+        self._recv_mv = memoryview(self._recv_buf)
+        # One UDP socket carries traffic to (and replies from) all the
+        # consumers; UDP is connectionless so there is no need for a
+        # socket per WSJTX instance
+        self._outbound = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._outbound.setblocking(0)
+        # Register sockets with a persistent selector (epoll/kqueue where
+        # available) instead of rebuilding a select() fdset every loop
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self.inbound, selectors.EVENT_READ, 'inbound')
+        self._sel.register(self._outbound, selectors.EVENT_READ, 'outbound')
+
+    def _route_inbound(self, data, addr):
         # WSJTX -> consumers
-        if self.inbound in readable:
-            data, addr = self.inbound.recvfrom(65535)
-            p = WSJPacket.parse(data)
-            try:
-                source = self.sources[p.ident]
-                # Always keep the endpoint updated in case of close/reopen
-                source.dest = addr
-            except KeyError:
-                # Only record new sources when they heartbeat. This is not
-                # necessary but allows us to log the ident/version when we
-                # see them once
-                if p.type == WSJTX_HEARTBEAT:
-                    LOG.info('New source found %s:%s - %r %r %r',
-                             addr[0], addr[1], p.ident, p.version, p.revision)
-                    self.sources[p.ident] = source = WSJTXSource(p.ident, addr)
-                else:
-                    source = None
-
-            LOG.info('Received type %i from %s', p.type, p.ident)
-
-            for dest in self.config.get('destinations', []):
-                # Proxy to all the configured destination consumers
-                host = dest.get('host', '127.0.0.1')
-                name = dest.get('name', '%s:%s' % (host, dest['port']))
-                try:
-                    source.proxysock.sendto(data, (host, dest['port']))
-                except AttributeError:
-                    # No source yet
-                    pass
-                except socket.error as e:
-                    LOG.warning('Unable to send to %s on port %i: %s' % (
-                        name, dest['port'], e))
-
-        # Reply consumer -> WSJTX
-        for ident, proxysock in proxysocks.items():
-            if proxysock not in readable:
-                continue
+        # Wrap once so all the parse-path slicing is zero-copy
+        message = memoryview(data)
+        number, ident = WSJPacket.parse_header(message)
+        if number is None:
+            return
+        source = self.sources.get(ident)
+        if source is not None:
+            # Always keep the endpoint updated in case of close/reopen
+            source.dest = addr
+        elif number == WSJTX_HEARTBEAT:
+            # Only record new sources when they heartbeat. This is not
+            # necessary but allows us to log the ident/version when we
+            # see them once. The full parse only exists to feed that
+            # log line, so skip it entirely when INFO is filtered
+            if self._info_enabled:
+                p = WSJPacket.parse(message)
+                LOG.info('New source found %s:%s - %r %r %r',
+                         addr[0], addr[1], p.ident, p.version, p.revision)
+            self.sources[ident] = source = WSJTXSource(str(ident, 'utf-8'),
+                                                       addr)
+
+        if self._info_enabled:
+            LOG.info('Received type %i from %s', number, ident)
+
+        destinations = self.destinations
+        if self._dest_sockaddrs:
+            # One syscall for the whole fan-out
             try:
-                data, addr = proxysock.recvfrom(65535)
-            except ConnectionResetError:
-                data = None
-                continue
-
-            # Parse the packet to determine the desired WSJ instance and
-            # send it there
-            p = WSJPacket.parse(data)
+                _sendmmsg.sendmmsg(self._outbound.fileno(), data,
+                                   self._dest_sockaddrs)
+            except OSError as e:
+                LOG.warning('Unable to send to destinations: %s', e)
+            return
+
+        for i, dest_addr in enumerate(destinations):
+            # Proxy to all the configured destination consumers
             try:
-                source = self.sources[p.ident]
-                self.inbound.sendto(data, source.dest)
-            except KeyError:
-                # Specified an unknown ident (not likely)
-                LOG.warning('Message from client %s for unknown source %s',
-                            addr[0], p.ident)
+                self._outbound.sendto(data, dest_addr)
             except socket.error as e:
-                LOG.warning('Unable to send to %s: %s' % (source.dest, e))
-            else:
+                LOG.warning('Unable to send to %s on port %i: %s',
+                            self._dest_names[i], dest_addr[1], e)
+
+    def _route_reply(self, data, addr):
+        # Reply consumer -> WSJTX. The ident in the packet body tells us
+        # which source it is for, so one socket can carry replies for
+        # all of them
+        ident = WSJPacket.parse_ident_only(memoryview(data))
+        if ident is None:
+            return
+        source = self.sources.get(ident)
+        if source is None:
+            # Specified an unknown ident (not likely)
+            LOG.warning('Message from client %s for unknown source %s',
+                        addr[0], ident)
+            return
+        try:
+            self.inbound.sendto(data, source.dest)
+        except socket.error as e:
+            LOG.warning('Unable to send to %s: %s', source.dest, e)
+        else:
+            if self._info_enabled:
                 LOG.info('Message from client %s, sending to %s host %s:%i',
-                            addr[0], source.ident, *source.dest)
+                         addr[0], source.ident, *source.dest)
+
+    def run_one(self):
+        # Kept short enough that the Windows service loop can still
+        # notice a stop request promptly, but long enough to avoid
+        # pointless wakeups when idle
+        events = self._sel.select(1.0)
+        if not events:
+            return
+
+        # Bind the hot attributes to locals once per wake-up; the drain
+        # loops below run per packet
+        recv_buf = self._recv_buf
+        recv_mv = self._recv_mv
+        inbound_recv = self.inbound.recvfrom_into
+        outbound_recv = self._outbound.recvfrom_into
+        route_inbound = self._route_inbound
+        route_reply = self._route_reply
+
+        for key, _ in events:
+            if key.data == 'inbound':
+                # Drain everything that is ready so the selector wake-up
+                # is paid once per burst instead of once per packet
+                while True:
+                    try:
+                        nbytes, addr = inbound_recv(recv_buf)
+                    except BlockingIOError:
+                        break
+                    route_inbound(bytes(recv_mv[:nbytes]), addr)
+            else:
+                while True:
+                    try:
+                        nbytes, addr = outbound_recv(recv_buf)
+                    except BlockingIOError:
+                        break
+                    except ConnectionResetError:
+                        continue
+                    route_reply(bytes(recv_mv[:nbytes]), addr)
 
 
 class POSIXQSOForwarder(QSOForwarder):
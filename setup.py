@@ -0,0 +1,12 @@
+"""Builds the optional _wsjtxparse C extension used by qsofwdsvc.py.
+
+This is not required; qsofwdsvc falls back to its pure-Python parser
+when the extension is not present.
+
+    python setup.py build_ext --inplace
+"""
+from setuptools import Extension
+from setuptools import setup
+
+setup(name='wsjtxparse',
+      ext_modules=[Extension('_wsjtxparse', ['_wsjtxparse.c'])])